@@ -0,0 +1,13 @@
+# Run a single ISS job
+#
+# This is started in the background by issjobs.py, with its output redirected
+# to the job's log file.  The only argument is the job directory.  Once ISS
+# exits, touch "success" in the job directory if it succeeded or "complete" if
+# it failed.
+import subprocess
+import sys
+import pathlib
+
+job_dir = sys.argv[1]
+rc = subprocess.run([sys.executable, "-m", "iss", f"{job_dir}/config.ini"]).returncode
+pathlib.Path(job_dir, "success" if rc == 0 else "complete").touch()
@@ -9,13 +9,23 @@
 # for all of the jobs and their log files to be stored.  Likewise, set up a
 # "password file", a single plain text file containing only a password.  This
 # must be outside of the git repo.
+#
+# For anything other than testing, run this behind nginx (see nginx.conf.example)
+# so that the static files, logs and config files are sent by nginx instead of
+# by a Python worker.  In that case, start Flask with HOST=127.0.0.1 ./run.sh so
+# that clients cannot bypass nginx and forge the X-Forwarded-For header, which
+# is trusted for the IP address in the password access log.
 import flask
+import werkzeug.middleware.proxy_fix
 import re
 import os
-import datetime
+import time
 import subprocess
-import glob
 import configparser
+import hmac
+import queue
+import threading
+import sys
 
 config = configparser.ConfigParser()
 config.read("config.ini")
@@ -24,25 +34,60 @@ PASSWORD_FILE = config['paths']['password_file']
 PASSWORD_ACCESS_LOG = config['paths']['password_access_log']
 PYTHON_PATH = config['paths']['python_path']
 SERVERS = dict(config['servers'])
+# Whether the server is running behind nginx, configured as in nginx.conf.example
+BEHIND_NGINX = config.getboolean('nginx', 'enabled', fallback=False)
+
+# Characters which are not allowed in user-chosen job names, messages, and job
+# names passed as GET arguments respectively.
+_JOBNAME_RE = re.compile(r'[^A-Za-z0-9_]')
+_MSG_RE = re.compile(r'[^A-Za-z0-9 ]')
+_JOB_ID_RE = re.compile(r'[^A-Za-z0-9_-]')
+
+# Match any of the servers in either Windows (\\server\) or Mac (smb://server/)
+# notation, so that they can all be replaced in a single pass.  Longer names
+# come first so that e.g. "zinu.cortexlab.net" is not cut short by "zinu".  The
+# pattern is only literals with no repetition, so it cannot backtrack more than
+# the length of the longest server name at each position.
+_SERVER_PATHS = {k.lower(): v for k,v in SERVERS.items()}
+# With no servers there is nothing to replace, and an empty alternation would
+# match every bare \\\ or smb:///.
+if _SERVER_PATHS:
+    _SERVER_RE = re.compile(r"(?:\\\\|smb://)(" + "|".join(re.escape(s) for s in sorted(_SERVER_PATHS, key=len, reverse=True)) + r")[\\/]", flags=re.IGNORECASE)
+else:
+    _SERVER_RE = None
 
 # We need to have a password for security reasons.  This entire script is not
 # at all secure, since it runs arbitrary code on a remote computer via HTTP, so
 # rather than trying to sanitise the .ini file, we just use a password as a
-# cheap trick to make sure only trusted users can upload.
+# cheap trick to make sure only trusted users can upload.  The password is read
+# once on startup, so restart the server after changing it.
+_current_dir = os.path.dirname(os.path.realpath(__file__))
+if _current_dir in PASSWORD_FILE:
+    exit("Error, password file must not be contained in the source directory.  This is to avoid accidentally committing it to the git repo.")
+if "/" not in PASSWORD_FILE.strip(".").strip("/"):
+    exit("Error, password file must not be a short relative path.  This is to avoid accidentally committing it to the git repo.")
+with open(PASSWORD_FILE, "r") as f:
+    _PASSWORD = f.read().strip().encode()
+
 def check_password(p):
-    current_dir = os.path.dirname(os.path.realpath(__file__))
-    if current_dir in PASSWORD_FILE:
-        exit("Error, password file must not be contained in the source directory.  This is to avoid accidentally committing it to the git repo.")
-    if "/" not in PASSWORD_FILE.strip(".").strip("/"):
-        exit("Error, password file must not be a short relative path.  This is to avoid accidentally committing it to the git repo.")
-    with open(PASSWORD_FILE, "r") as f:
-        password = f.read().strip()
-    return p == password
-
-# This will not only check whether the password is empty, but will also ensure
-# that it crashes immediately after it is run instead of while a user is
-# submitting.
-assert not check_password(""), "Password must not be empty"
+    # Compare in constant time, as bytes so that non-ASCII input is allowed
+    return hmac.compare_digest(p.encode(), _PASSWORD)
+
+# Check that the password is not empty.  This is not an assert so that it still
+# happens when Python is run with -O.
+if _PASSWORD == b"":
+    exit("Error, password must not be empty")
+
+# The timestamp for the access log only changes once per second, so remember
+# the last one instead of formatting it on each attempt.
+_LAST_TIMESTAMP = {"second": -1, "formatted": ""}
+
+def _log_timestamp():
+    now = int(time.time())
+    if now != _LAST_TIMESTAMP["second"]:
+        _LAST_TIMESTAMP["formatted"] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+        _LAST_TIMESTAMP["second"] = now
+    return _LAST_TIMESTAMP["formatted"]
 
 # We really have no security on this so I improvised a security method.  If the
 # password is incorrect, log the incorrect password into the access log, along
@@ -51,9 +96,34 @@ assert not check_password(""), "Password must not be empty"
 # sketchy.  If not, just delete the log.  If so, then someone is trying to
 # access the system and this could be VERY bad.
 def log_incorrect_password(p):
-    logline = f"date={datetime.datetime.today()}, ip={flask.request.remote_addr}, password={p}\n"
-    with open(PASSWORD_ACCESS_LOG, "a") as f:
-        f.write(logline)
+    global _BAD_PW_COUNT
+    logline = f"date={_log_timestamp()}, ip={flask.request.remote_addr}, password={p}\n"
+    _PASSWORD_LOG_QUEUE.put_nowait(logline)
+    # Requests are handled in threads, so make sure no attempts are missed
+    with _BAD_PW_LOCK:
+        _BAD_PW_COUNT += 1
+
+# Lines for the access log are written by a single background thread, which
+# keeps the file open and writes everything that is waiting in one go, so a
+# burst of incorrect passwords does not mean a burst of small writes.  The
+# count of incorrect passwords is still updated immediately by
+# log_incorrect_password.
+_PASSWORD_LOG_QUEUE = queue.Queue()
+
+# If the log cannot be written, report it and stop the thread, after which
+# confirm_password_log_not_full refuses all submissions.
+def _password_log_writer():
+    try:
+        with open(PASSWORD_ACCESS_LOG, "a", buffering=1<<16) as f:
+            while True:
+                f.write(_PASSWORD_LOG_QUEUE.get())
+                try:
+                    while True:
+                        f.write(_PASSWORD_LOG_QUEUE.get_nowait())
+                except queue.Empty:
+                    f.flush()
+    except OSError as e:
+        print(f"Error, could not write to the password access log, so all submissions will be refused: {e}", file=sys.stderr, flush=True)
 
 # Check to make sure that no more than 100 total incorrect passwords have
 # occurred.  This will probably fill up at some point from healthy usage and
@@ -61,71 +131,134 @@ def log_incorrect_password(p):
 # look to make sure they're not all from the same IP and that the passwords are
 # reasonable accidents, not a brute force attack.
 def confirm_password_log_not_full():
-    with open(PASSWORD_ACCESS_LOG, "r") as f:
-        nlines = len(f.readlines())
-    return nlines < 100
+    return _PASSWORD_LOG_WRITER.is_alive() and _BAD_PW_COUNT < 100
+
+# The number of lines in the access log is counted once on startup and then
+# kept up to date by log_incorrect_password, so remember to restart the server
+# after emptying the log.
+def _count_log_lines():
+    nlines = 0
+    with open(PASSWORD_ACCESS_LOG, "rb", buffering=1<<16) as f:
+        while block := f.read(1<<16):
+            nlines += block.count(b"\n")
+    return nlines
+
+_BAD_PW_COUNT = _count_log_lines()
+_BAD_PW_LOCK = threading.Lock()
+
+# Only start writing to the access log once its lines have been counted
+_PASSWORD_LOG_WRITER = threading.Thread(target=_password_log_writer, daemon=True)
+_PASSWORD_LOG_WRITER.start()
 
 
 # Choose a valid name for the job based on the one the user has optionally
 # specified.
 def jobname(chosen=""):
-    sanitised = re.sub(r'[^A-Za-z0-9_]', '', chosen)
+    sanitised = _JOBNAME_RE.sub('', chosen)
     if sanitised == "":
         sanitised = "job"
-    sanitised = datetime.datetime.today().strftime('%Y-%m-%d_%H-%M-%S') + "_" + sanitised
+    sanitised = time.strftime('%Y-%m-%d_%H-%M-%S') + "_" + sanitised
+    with os.scandir(OUTPUT_DIR) as it:
+        existing = {e.name for e in it if e.name.startswith(sanitised)}
     suffix = 0
     jname = sanitised
-    while os.path.isdir(OUTPUT_DIR + "/"+jname):
+    while jname in existing:
         jname = sanitised + str(suffix)
         suffix += 1
     #os.mkdir(OUTPUT_DIR + jname)
     return jname
 
 app = flask.Flask(__name__)
+# Templates are compiled once by Jinja and never change while the server is
+# running, so there is no need to check them for modifications on each render.
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+# Behind nginx, take the client's IP address from X-Forwarded-For so that the
+# password access log records the real IP rather than nginx's.
+if BEHIND_NGINX:
+    app.wsgi_app = werkzeug.middleware.proxy_fix.ProxyFix(app.wsgi_app, x_for=1)
 
-# Serve the CSS
+# Serve the CSS and JS.  These only change when the server is updated, so let
+# browsers cache them for a day.  Behind nginx these routes are never reached.
 @app.route("/beauter.min.css")
 def beauter_css():
-    with open("beauter.min.css") as f:
-        return flask.Response(f.read(), mimetype='text/css')
+    return flask.send_file("beauter.min.css", mimetype='text/css', conditional=True, max_age=86400)
 
 @app.route("/beauter.min.js")
 def beauter_js():
-    with open("beauter.min.js") as f:
-        return flask.Response(f.read(), mimetype='text/javascript')
+    return flask.send_file("beauter.min.js", mimetype='text/javascript', conditional=True, max_age=86400)
 
 # The home page where users may submit jobs
 @app.route("/")
 def home():
-    with open("_index_template.html") as f:
-        template = f.read()
     if "m" in flask.request.args:
-        m_safe = re.sub(r'[^A-Za-z0-9 ]', '', flask.request.args['m'])
+        m_safe = _MSG_RE.sub('', flask.request.args['m'])
     else:
         m_safe = ""
-    return flask.render_template_string(template, message=m_safe, servers=SERVERS.keys(), currently_running=currently_running())
+    return flask.render_template('_index_template.html', message=m_safe, servers=SERVERS.keys(), currently_running=currently_running())
+
+# Job directories are cached between requests.  Creating a new job directory
+# updates the modification time of OUTPUT_DIR, so a full rescan is only needed
+# when that changes.  Otherwise, only jobs which have not yet finished need to
+# be checked again.  A job never changes once it is complete, so finished jobs
+# are kept in "finished" and their directories are never looked at again.
+_JOB_CACHE = {"mtime": -1, "jobs": [], "finished": {}}
+_JOB_CACHE_LOCK = threading.Lock()
+
+def _job_status(name):
+    """Status of a single job, as stored in the job cache
+
+    Call this with _JOB_CACHE_LOCK held, since it may update the cache.
+    """
+    if name in _JOB_CACHE["finished"]:
+        return _JOB_CACHE["finished"][name]
+    entries = set(os.listdir(f"{OUTPUT_DIR}/{name}"))
+    job = {"name": name,
+           "complete": "complete" in entries,
+           "success": "success" in entries,
+           "log": "output.log" in entries}
+    if job["complete"] or job["success"]:
+        _JOB_CACHE["finished"][name] = job
+    return job
 
-def currently_running():
+def _scan_jobs():
+    """Status of every job in the output directory, sorted by name
+
+    Callers which need several of the lists below should call this once and
+    filter the result themselves.
+    """
+    # Requests are handled in threads, so only one of them may check and
+    # update the cache at a time.
+    with _JOB_CACHE_LOCK:
+        mtime = os.stat(OUTPUT_DIR).st_mtime_ns
+        if mtime != _JOB_CACHE["mtime"]:
+            with os.scandir(OUTPUT_DIR) as it:
+                names = sorted(entry.name for entry in it if entry.is_dir())
+            # Forget about any jobs which have been deleted
+            _JOB_CACHE["finished"] = {n: _JOB_CACHE["finished"][n] for n in names if n in _JOB_CACHE["finished"]}
+        else:
+            names = [j["name"] for j in _JOB_CACHE["jobs"]]
+        jobs = [_job_status(name) for name in names]
+        _JOB_CACHE["mtime"] = mtime
+        _JOB_CACHE["jobs"] = jobs
+    return jobs
+
+def currently_running(jobs=None):
     """List of job names that are currently running"""
-    completed = sorted(glob.glob(f"{OUTPUT_DIR}/*/complete"))[::-1]
-    success = sorted(glob.glob(f"{OUTPUT_DIR}/*/success"))[::-1]
-    log_files = sorted(glob.glob(f"{OUTPUT_DIR}/*/output.log"))[::-1]
-    names_log = [f.split("/")[-2] for f in log_files]
-    names_completed = [f.split("/")[-2] for f in completed+success]
-    running = set(names_log)-set(names_completed)
-    return sorted(list(running))
-
-def succeeded():
+    if jobs is None:
+        jobs = _scan_jobs()
+    return [j["name"] for j in jobs if j["log"] and not (j["complete"] or j["success"])]
+
+def succeeded(jobs=None):
     """List of job names that succeeded"""
-    successful = sorted(glob.glob(f"{OUTPUT_DIR}/*/success"))[::-1]
-    names_success = [f.split("/")[-2] for f in successful]
-    return sorted(list(names_success))
+    if jobs is None:
+        jobs = _scan_jobs()
+    return [j["name"] for j in jobs if j["success"]]
 
-def failed():
+def failed(jobs=None):
     """List of job names that failed"""
-    successful = sorted(glob.glob(f"{OUTPUT_DIR}/*/success"))[::-1]
-    names_success = [f.split("/")[-2] for f in successful]
-    return sorted(list(names_success))
+    if jobs is None:
+        jobs = _scan_jobs()
+    return [j["name"] for j in jobs if j["complete"] and not j["success"]]
 
 @app.template_filter('plural')
 def plural(l, singular = '', plural = 's'):
@@ -134,6 +267,9 @@ def plural(l, singular = '', plural = 's'):
     else:
         return plural
 
+# Chunk size used when copying uploaded config files to disk
+UPLOAD_BUFFER_SIZE = 64*1024
+
 # POST requests to submit new jobs are sent here.
 @app.route("/submit", methods=["POST"])
 def submit():
@@ -148,7 +284,9 @@ def submit():
     if f.filename == "":
         return flask.redirect("/?m=No file uploaded")
     os.mkdir(f"{OUTPUT_DIR}/{name}/")
-    f.save(f"{OUTPUT_DIR}/{name}/config.original.ini")
+    # The config file is needed by fix_ini straight away, so save it here
+    # rather than in the background, but copy it in larger chunks.
+    f.save(f"{OUTPUT_DIR}/{name}/config.original.ini", buffer_size=UPLOAD_BUFFER_SIZE)
     fix_ini(name)
     run(name, resp['username'])
     return flask.redirect(f"/view?job={name}")
@@ -162,19 +300,23 @@ def fix_ini(name):
     with open(f"{OUTPUT_DIR}/{name}/config.original.ini", "r") as f:
         contents = f.read()
     # Switch the filenames
-    for servername,serverpath in SERVERS.items():
-        contents = re.sub(r"\\\\"+servername+r"\\", serverpath, contents, flags=re.IGNORECASE)
-        contents = re.sub("smb://"+servername+"/", serverpath, contents, flags=re.IGNORECASE)
+    if _SERVER_RE is not None:
+        contents = _SERVER_RE.sub(lambda m: _SERVER_PATHS[m.group(1).lower()], contents)
     contents = contents.replace("\\", "/")
     contents = ";;; WARNING - This file is autogenerated from the real config file config.original.ini.  Paths and escape sequences have been modified.\n\n\n" + contents
     with open(f"{OUTPUT_DIR}/{name}/config.ini", "w") as f:
         f.write(contents)
 
-# Run the ISS software
+# Run the ISS software.  This is done through a small wrapper script, started
+# directly rather than through a shell, which marks the job as finished once
+# ISS exits.
+_RUN_JOB_SCRIPT = f"{_current_dir}/_run_job.py"
+
 def run(name, person):
     with open(f"{OUTPUT_DIR}/{name}/output.log", "w") as f:
-        f.write(f"Started output for job '{name}', user '{person}' at {datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S')}\n")
-    subprocess.Popen(f"{PYTHON_PATH} -m iss {OUTPUT_DIR}/{name}/config.ini >> {OUTPUT_DIR}/{name}/output.log 2>&1 && touch {OUTPUT_DIR}/{name}/success || touch {OUTPUT_DIR}/{name}/complete", shell=True)
+        f.write(f"Started output for job '{name}', user '{person}' at {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+        f.flush()
+        subprocess.Popen([PYTHON_PATH, _RUN_JOB_SCRIPT, f"{OUTPUT_DIR}/{name}"], stdout=f, stderr=subprocess.STDOUT, close_fds=True, start_new_session=True)
 
 # View either a list of all previous jobs or of a specific job (given by the
 # "job" GET argument)
@@ -182,29 +324,40 @@ def run(name, person):
 def view():
     # Handle the case of viewing a single record
     if "job" in flask.request.args:
-        with open("_job_template.html") as f:
-            template = f.read()
-        job_safe = re.sub(r'[^A-Za-z0-9_-]', '', flask.request.args['job'])
+        job_safe = _JOB_ID_RE.sub('', flask.request.args['job'])
         if job_safe != flask.request.args['job']:
             return flask.redirect("/?m=Invalid file")
-        with open(f"{OUTPUT_DIR}/{job_safe}/output.log") as f:
-            contents = f.read()
-        if os.path.isfile(f"{OUTPUT_DIR}/{job_safe}/success"):
+        if job_safe == "" or not os.path.isdir(f"{OUTPUT_DIR}/{job_safe}"):
+            return flask.redirect("/?m=Invalid job name")
+        with _JOB_CACHE_LOCK:
+            job = _job_status(job_safe)
+        if job["success"]:
             status = "success"
-        elif os.path.isfile(f"{OUTPUT_DIR}/{job_safe}/complete"):
+        elif job["complete"]:
             status = "error"
         else:
             status = ""
-        return flask.render_template_string(template, log_file=contents, job_name=job_safe, status=status)
+        return flask.render_template('_job_template.html', job_name=job_safe, status=status)
     # Handle the case of viewing all records in a list
     else:
-        with open("_list_template.html") as f:
-            template = f.read()
-        log_files = sorted(glob.glob(f"{OUTPUT_DIR}/*/output.log"))[::-1]
-        print(template)
-        names = [f.split("/")[-2] for f in log_files]
-        print(names)
-        return flask.render_template_string(template, names=names, succeeded=succeeded(), currently_running=currently_running())
+        jobs = _scan_jobs()
+        names = [j["name"] for j in jobs if j["log"]][::-1]
+        return flask.render_template('_list_template.html', names=names, succeeded=succeeded(jobs), currently_running=currently_running(jobs))
+
+# Send a file from a job's directory.  Behind nginx, this only sets a header
+# telling nginx which file to send, from the internal /_jobfiles/ location.
+def _send_job_file(job, filename, mimetype, max_age=None):
+    if BEHIND_NGINX:
+        resp = flask.Response(mimetype=mimetype)
+        resp.headers['X-Accel-Redirect'] = f"/_jobfiles/{job}/{filename}"
+        # Match send_file, which tells browsers to revalidate if there is no
+        # max_age.  nginx passes this header on.
+        if max_age is not None:
+            resp.cache_control.max_age = max_age
+        else:
+            resp.cache_control.no_cache = True
+        return resp
+    return flask.send_file(f"{OUTPUT_DIR}/{job}/{filename}", as_attachment=False, mimetype=mimetype, conditional=True, max_age=max_age)
 
 # Retrieve the config file
 @app.route("/ini")
@@ -212,10 +365,24 @@ def showini():
     # Handle the case of viewing a single record
     if "job" not in flask.request.args:
         return flask.redirect("/?m=Invalid file")
-    job_safe = re.sub(r'[^A-Za-z0-9_-]', '', flask.request.args['job'])
+    job_safe = _JOB_ID_RE.sub('', flask.request.args['job'])
     if job_safe != flask.request.args['job']:
         return flask.redirect("/?m=Invalid file")
     path = f"{OUTPUT_DIR}/{job_safe}/config.original.ini"
     if not os.path.isfile(path):
         return flask.redirect("/?m=Invalid job name")
-    return flask.send_file(path, as_attachment=False, mimetype='text/plain')
+    return _send_job_file(job_safe, "config.original.ini", mimetype='text/plain', max_age=60)
+
+# Retrieve the log file.  This is shown in the job page as plain text, so the
+# browser does the rendering and the log never needs to be escaped.
+@app.route("/rawlog")
+def rawlog():
+    if "job" not in flask.request.args:
+        return flask.redirect("/?m=Invalid file")
+    job_safe = _JOB_ID_RE.sub('', flask.request.args['job'])
+    if job_safe != flask.request.args['job']:
+        return flask.redirect("/?m=Invalid file")
+    path = f"{OUTPUT_DIR}/{job_safe}/output.log"
+    if not os.path.isfile(path):
+        return flask.redirect("/?m=Invalid job name")
+    return _send_job_file(job_safe, "output.log", mimetype='text/plain')
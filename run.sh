@@ -1,2 +1,3 @@
 export FLASK_APP=issjobs
-flask run --host=0.0.0.0
+# Behind nginx, run with HOST=127.0.0.1 so that only nginx can reach Flask
+flask run --host=${HOST:-0.0.0.0}